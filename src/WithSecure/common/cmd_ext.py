@@ -1,6 +1,8 @@
 import cmd
+import errno
+import functools
 import os
-from platform import platform
+import re
 from drozer import meta
 
 # readline works on linux/mac
@@ -20,10 +22,38 @@ except ModuleNotFoundError:
 import shlex
 import sys
 import textwrap
+import threading
 
 from WithSecure.common import system
 from WithSecure.common.text import wrap
 
+_sep = os.path.sep
+
+# special variables, referencing the previous command
+_BANG_RE = re.compile(r"!!|!\$|!\^|!\*")
+
+
+def _fast_split(s):
+    """
+    Split a line into arguments, only falling back to shlex if there is some
+    quoting or escaping to process.
+    """
+
+    if '"' not in s and "'" not in s and "\\" not in s:
+        return s.split()
+    else:
+        return shlex.split(s)
+
+
+@functools.lru_cache(maxsize=None)
+def _doc_leader(cls):
+    """
+    Format a class docstring for use as a doc_leader. Docstrings do not
+    change, so this is only done once per class.
+    """
+
+    return wrap(textwrap.dedent(cls.__doc__))
+
 
 class Cmd(cmd.Cmd):
     """
@@ -42,17 +72,22 @@ class Cmd(cmd.Cmd):
     def __init__(self):
         cmd.Cmd.__init__(self)
 
+        self.__complete_map = {name[9:]: getattr(self, name) for name in dir(self) if name.startswith("complete_")}
         self.__completer_stack = []
         self.__history_stack = []
+        self.__lastcmd_argv = (None, None)
         self.__output_redirected = None
+        self.__version_lookup = None
 
         self.aliases = {}
         self.doc_header = "Commands:"
-        self.doc_leader = wrap(textwrap.dedent(self.__class__.__doc__))
+        self.doc_leader = _doc_leader(type(self))
         self.history_file = None
         self.ruler = " "
         self.stdout = self.stdout
         self.stderr = sys.stderr
+        self.__var_names = frozenset()
+        self.__var_pattern = None
         self.variables = {}
 
     def cmdloop(self, intro=None):
@@ -70,7 +105,11 @@ class Cmd(cmd.Cmd):
                 if self.cmdqueue:
                     line = self.cmdqueue.pop(0)
                 else:
+                    self.__report_versions()
+
                     if self.use_rawinput:
+                        # anything still buffered from the last command must appear before the prompt
+                        self.stdout.flush()
                         try:
                             line = input(self.prompt)
                         except EOFError:
@@ -89,7 +128,10 @@ class Cmd(cmd.Cmd):
                     stop = self.onecmd(line)
                     stop = self.postcmd(stop, line)
                 except ValueError as e:
-                    if e.message == "No closing quotation":
+                    # postcmd was skipped, so remove any output redirection here
+                    self.__restore_output()
+
+                    if e.args and e.args[0] == "No closing quotation":
                         self.stderr.write(
                             "Failed to parse your command, because there were unmatched quotation marks.\n")
                         self.stderr.write(
@@ -101,7 +143,6 @@ class Cmd(cmd.Cmd):
         except Exception as e:
             print("Loop exception")
             self.handleException(e)
-            pass
 
         finally:
             if self.use_rawinput and self.completekey:
@@ -116,34 +157,7 @@ class Cmd(cmd.Cmd):
         """
 
         if state == 0:
-            if has_readline:
-                origline = readline.get_line_buffer()
-                line = origline.lstrip()
-                stripped = len(origline) - len(line)
-                begidx = readline.get_begidx() - stripped
-                endidx = readline.get_endidx() - stripped
-
-                if begidx > 0:
-                    if ">" in line and begidx > line.index(">"):
-                        self.completion_matches = self.completefilename(text, line, begidx, endidx)
-                        return self.completion_matches[0]
-
-                    command = self.parseline(line)[0]
-                    if command == '':
-                        compfunc = self.completedefault
-                    else:
-                        try:
-                            compfunc = getattr(self, 'complete_' + command)
-                        except AttributeError:
-                            compfunc = self.completedefault
-                else:
-                    compfunc = self.completenames
-
-                matches = compfunc(text, line, begidx, endidx)
-                if len(matches) == 1 and matches[0].endswith(os.path.sep):
-                    self.completion_matches = matches
-                else:
-                    self.completion_matches = list(map(lambda s: s + " ", matches))
+            self.__find_completion_matches(text)
 
         try:
             return self.completion_matches[state]
@@ -167,10 +181,13 @@ class Cmd(cmd.Cmd):
         support for aliases.
         """
 
-        argv = shlex.split(line)
+        # pass the rest of the line through untouched, so the command sees the user's own quoting
+        parts = line.split(None, 1)
+        command = parts[0]
+        rest = parts[1] if len(parts) > 1 else ""
 
-        if argv[0] in self.aliases:
-            getattr(self, "do_" + self.aliases[argv[0]])(" ".join(argv[1:]))
+        if command in self.aliases:
+            return getattr(self, "do_" + self.aliases[command])(rest)
         else:
             cmd.Cmd.default(self, line)
 
@@ -196,8 +213,8 @@ class Cmd(cmd.Cmd):
         Prints out all environment variables, that can be used to substitute values in commands, and are passed into the Android shell
         """
 
-        for key in self.variables:
-            print("%s=%s" % (key, self.variables[key]), end="\n")
+        if self.variables:
+            self.stdout.write("\n".join(f"{key}={value}" for key, value in self.variables.items()) + "\n")
 
     def do_set(self, arguments):
         """
@@ -211,9 +228,9 @@ class Cmd(cmd.Cmd):
             dz> run app.package.info -a $P
         """
 
-        for kv in shlex.split(arguments):
-            if "=" in kv:
-                key, value = kv.split("=", 1)
+        for kv in _fast_split(arguments):
+            key, sep, value = kv.partition("=")
+            if sep:
                 self.variables[key] = value
 
     def do_unset(self, arguments):
@@ -223,7 +240,7 @@ class Cmd(cmd.Cmd):
         Removes one-or-more values previously stored in variables.
         """
 
-        for key in shlex.split(arguments):
+        for key in _fast_split(arguments):
             if key in self.variables:
                 del self.variables[key]
 
@@ -248,13 +265,7 @@ class Cmd(cmd.Cmd):
         Remove output redirection when a command has finished executing.
         """
 
-        if self.__output_redirected != None:
-            tee = self.stdout
-            self.stdout = self.__output_redirected
-
-            self.__output_redirected = None
-
-            del (tee)
+        self.__restore_output()
 
         return stop
 
@@ -267,6 +278,10 @@ class Cmd(cmd.Cmd):
         # perform Bash-style substitutions
         line = self.__do_substitutions(line)
 
+        # only tokenize the line if there could be a redirection in it
+        if ">" not in line:
+            return line
+
         parsed_line = shlex.split(line)
         # perform output stream redirection (as in the `tee` command)
         if ">" in parsed_line or ">>" in parsed_line:
@@ -275,73 +290,100 @@ class Cmd(cmd.Cmd):
         return line
 
     def checkVer(self):
-        # check for new console versions
-        try:
-            latest, date = meta.latest_version()
-            if latest is not None:
-                if meta.version > latest:
-                    print("It seems that you are running a drozer pre-release. Brilliant!\n\nPlease send any bugs, feature requests or other feedback to our GitHub project:\nhttps://github.com/WithSecureLabs/drozer\n\nYour contributions help us to make drozer awesome.\n")
-                elif meta.version < latest:
-                    print("It seems that you are running an old version of drozer. drozer v%s was\nreleased on %s. We suggest that you update your copy to make sure that\nyou have the latest features and fixes.\n\nTo download the latest drozer visit:\nhttps://github.com/WithSecureLabs/drozer/releases\n" % (latest, date))
-        except Exception as e:
-            #silence this exception unless in debug mode
-            self.handleException(e, shutup=True)
-            pass
-        # check for new agent versions
+        # look up the latest releases in the background, so the prompt is never held up by the network
+        self.__latest_versions = (None, None)
+        self.__version_lookup = threading.Thread(target=self.__fetch_latest_versions, daemon=True)
+        self.__version_lookup.start()
+
+        # find the installed agent version, which must be done from this thread
         try:
             context = self.context()
             packageManager = context.getPackageManager()
-            agentVersion = meta.Version(packageManager.getPackageInfo(context.getPackageName(), packageManager.GET_META_DATA).versionName)
-            latestAgent, dateAgent = meta.latest_agent_version()
-            if latestAgent is not None:
-                if agentVersion < latestAgent:
-                    print("It seems that you are running an old version of drozer-agent. drozer-agent v%s was\nreleased on %s. We suggest that you update your copy to make sure that\nyou have the latest features and fixes.\n\nTo download the latest drozer-agent visit:\nhttps://github.com/WithSecureLabs/drozer-agent/releases\n" % (latestAgent, dateAgent))
+            self.__agent_version = meta.Version(packageManager.getPackageInfo(context.getPackageName(), packageManager.GET_META_DATA).versionName)
         except Exception as e:
             self.handleException(e, shutup=True)
-            pass
+            self.__agent_version = None
+
+        self.__report_versions()
 
     def preloop(self):
         if self.intro:
             self.stdout.write(str(self.intro) + "\n")
         self.checkVer()
 
-    def push_completer(self, completer, history_file=None):
-        if has_readline:
+    # the readline-backed implementations are chosen once, rather than checking has_readline on every call
+    if has_readline:
+        def push_completer(self, completer, history_file=None):
             self.__completer_stack.append(readline.get_completer())
             readline.set_completer(completer)
             readline.set_completer_delims(readline.get_completer_delims().replace("/", ""))
 
-            if len(self.__history_stack) > 0 and self.__history_stack[-1]:
-                readline.write_history_file(self.__history_stack[-1])
+            # keep the outer history in memory, rather than round-tripping it through its history file
+            saved_history = [readline.get_history_item(i) for i in range(1, readline.get_current_history_length() + 1)]
 
-            self.__history_stack.append(history_file)
+            self.__history_stack.append((history_file, saved_history))
             readline.clear_history()
             if history_file is not None and os.path.exists(history_file):
                 try:
                     # In macOS, this line causes a `[Errno 1] Operation not permitted` if there is a `~/.drozer_history`
                     readline.read_history_file(history_file)
                 except IOError as e:
-                    if "darwin" in platform().lower() and str(e).strip() == "[Errno 1] Operation not permitted":
-                        print
-                        "Could not access the history file..."
+                    if sys.platform == "darwin" and e.errno == errno.EPERM:
+                        self.stderr.write("Could not access the history file...\n")
                     else:
                         raise e
 
             readline.parse_and_bind(self.completekey + ": complete")
 
-    def pop_completer(self):
-        if has_readline:
-            if self.__history_stack[-1] != None:
-                readline.write_history_file(self.__history_stack.pop())
-            else:
-                self.__history_stack.pop()
+        def pop_completer(self):
+            history_file, saved_history = self.__history_stack.pop()
+            if history_file != None:
+                readline.write_history_file(history_file)
 
             readline.clear_history()
-            if len(self.__history_stack) > 0 and self.__history_stack[-1]:
-                readline.read_history_file(self.__history_stack[-1])
+            for line in saved_history:
+                readline.add_history(line)
 
             readline.set_completer(self.__completer_stack.pop())
 
+        def __find_completion_matches(self, text):
+            get_line_buffer, get_begidx, get_endidx = readline.get_line_buffer, readline.get_begidx, readline.get_endidx
+
+            origline = get_line_buffer()
+            line = origline.lstrip()
+            stripped = len(origline) - len(line)
+            begidx = get_begidx() - stripped
+            endidx = get_endidx() - stripped
+
+            if begidx > 0:
+                if ">" in line and begidx > line.index(">"):
+                    self.completion_matches = self.completefilename(text, line, begidx, endidx)
+                    return
+
+                command = self.parseline(line)[0]
+                if command == '':
+                    compfunc = self.completedefault
+                else:
+                    compfunc = self.__complete_map.get(command, self.completedefault)
+            else:
+                compfunc = self.completenames
+
+            matches = compfunc(text, line, begidx, endidx)
+            if len(matches) == 1 and matches[0].endswith(_sep):
+                self.completion_matches = matches
+            else:
+                self.completion_matches = [s + " " for s in matches]
+
+    else:
+        def push_completer(self, completer, history_file=None):
+            pass
+
+        def pop_completer(self):
+            pass
+
+        def __find_completion_matches(self, text):
+            self.completion_matches = []
+
     def __build_tee(self, console, destination):
         """
         Create a WithSecure.system.Tee object to be used by output redirection.
@@ -355,6 +397,48 @@ class Cmd(cmd.Cmd):
 
         return system.Tee(console, destination.strip(), mode)
 
+    def __fetch_latest_versions(self):
+        latestVersion = latestAgentVersion = None
+        try:
+            latestVersion = meta.latest_version()
+        except Exception as e:
+            #silence this exception unless in debug mode
+            self.handleException(e, shutup=True)
+        try:
+            latestAgentVersion = meta.latest_agent_version()
+        except Exception as e:
+            self.handleException(e, shutup=True)
+
+        self.__latest_versions = (latestVersion, latestAgentVersion)
+
+    def __report_versions(self):
+        """
+        Print any version notices, once the background lookup has finished.
+
+        This is called from the main thread between commands, so that the
+        notices cannot interrupt the user's input.
+        """
+
+        if self.__version_lookup is None or self.__version_lookup.is_alive():
+            return
+        self.__version_lookup = None
+
+        latestVersion, latestAgentVersion = self.__latest_versions
+
+        # check for new console versions
+        if latestVersion is not None:
+            latest, date = latestVersion
+            if meta.version > latest:
+                print("It seems that you are running a drozer pre-release. Brilliant!\n\nPlease send any bugs, feature requests or other feedback to our GitHub project:\nhttps://github.com/WithSecureLabs/drozer\n\nYour contributions help us to make drozer awesome.\n")
+            elif meta.version < latest:
+                print("It seems that you are running an old version of drozer. drozer v%s was\nreleased on %s. We suggest that you update your copy to make sure that\nyou have the latest features and fixes.\n\nTo download the latest drozer visit:\nhttps://github.com/WithSecureLabs/drozer/releases\n" % (latest, date))
+
+        # check for new agent versions
+        if self.__agent_version is not None and latestAgentVersion is not None:
+            latestAgent, dateAgent = latestAgentVersion
+            if self.__agent_version < latestAgent:
+                print("It seems that you are running an old version of drozer-agent. drozer-agent v%s was\nreleased on %s. We suggest that you update your copy to make sure that\nyou have the latest features and fixes.\n\nTo download the latest drozer-agent visit:\nhttps://github.com/WithSecureLabs/drozer-agent/releases\n" % (latestAgent, dateAgent))
+
     def __do_substitutions(self, line):
         """
         Perform substitution of Bash-style variables.
@@ -364,31 +448,80 @@ class Cmd(cmd.Cmd):
         if not line:
             return ""
 
-            # perform any arbitrary variable substitutions, from the dictionary
-        for name in self.variables:
-            line = line.replace("$%s" % name, self.variables[name])
+        if "$" not in line and "!" not in line:
+            return line
+
+        # perform any arbitrary variable substitutions, from the dictionary
+        if "$" in line:
+            pattern = self.__variable_pattern()
+
+            if pattern is not None:
+                line = pattern.sub(lambda m: self.variables.get(m.group(1), m.group(0)), line)
 
         # perform special variable substitutions, referencing the previous command
-        if line.find("!!") >= 0 or line.find("!$") >= 0 or line.find("!^") >= 0 or line.find("!*") >= 0:
+        if "!" in line and _BANG_RE.search(line):
             line = self.__do_last_command_substitutions(line)
 
         return line
 
     def __do_last_command_substitutions(self, line):
         if self.lastcmd != "":
-            argv = shlex.split(self.lastcmd)
-
-            line = line.replace("!!", self.lastcmd)
-            line = line.replace("!$", argv[-1])
-            line = line.replace("!^", argv[1])
-            line = line.replace("!*", " ".join(argv[1:]))
+            # the previous command only changes between lines, so tokenize it once
+            lastcmd, argv = self.__lastcmd_argv
+            if lastcmd is not self.lastcmd:
+                argv = shlex.split(self.lastcmd)
+                self.__lastcmd_argv = (self.lastcmd, argv)
 
-            return line
+            return _BANG_RE.sub(lambda m: self.__last_command_substitution(m.group(0), argv), line)
         else:
             self.stderr.write("no previous command\n")
 
             return ""
 
+    def __last_command_substitution(self, special, argv):
+        """
+        Find the value of a special variable (!!, !$, !^ or !*), given the
+        arguments of the previous command.
+        """
+
+        if special == "!!":
+            return self.lastcmd
+        elif special == "!$":
+            return argv[-1] if len(argv) > 0 else ""
+        elif special == "!^":
+            return argv[1] if len(argv) > 1 else ""
+        else:
+            return " ".join(argv[1:])
+
+    def __restore_output(self):
+        """
+        Remove output redirection, pointing stdout back at the console.
+        """
+
+        if self.__output_redirected != None:
+            self.stdout = self.__output_redirected
+
+            self.__output_redirected = None
+
+    def __variable_pattern(self):
+        """
+        Build (or fetch the cached) regex matching any of the defined variables.
+
+        Names are sorted longest-first, so that $PP is not shadowed by $P. The
+        regex is rebuilt whenever the set of names changes, since variables is
+        also modified directly (e.g., by modules sharing the session's dict).
+        """
+
+        if self.variables.keys() != self.__var_names:
+            self.__var_names = frozenset(self.variables)
+            if self.__var_names:
+                names = sorted(self.__var_names, key=len, reverse=True)
+                self.__var_pattern = re.compile(r"\$(" + "|".join(map(re.escape, names)) + ")")
+            else:
+                self.__var_pattern = None
+
+        return self.__var_pattern
+
     def __redirect_output(self, line):
         """
         Set up output redirection, by building a Tee between stdout and the
@@ -46,3 +46,11 @@ class Tee(object):
         self.console.write(data)
         self.file.write(data)
         self.file.flush()
+
+    def flush(self):
+        """
+        Flush both the console and the file stream.
+        """
+
+        self.console.flush()
+        self.file.flush()
@@ -1,6 +1,10 @@
 from urllib.request import urlopen, Request
 from urllib.error import HTTPError, URLError
+from threading import Lock
+import functools
 import json
+import os
+import time
 import drozer
 
 class Version:
@@ -30,6 +34,60 @@ class Version:
 
 version = Version(drozer.__version__)
 
+# how long (in seconds) to trust a cached release lookup before asking GitHub again
+cache_ttl = 6 * 60 * 60
+cache_file = os.path.sep.join([os.path.expanduser("~"), ".drozer_version_cache"])
+_cache_lock = Lock()
+
+def _read_cache():
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    # anything other than a dict is a corrupt cache, which will be overwritten
+    return cache if isinstance(cache, dict) else {}
+
+def _cached(key, ttl=cache_ttl):
+    """
+    Cache the (Version, date) result of a release lookup on disk, as a JSON
+    dict of {key: [timestamp, [version, date]]}, for up to ttl seconds.
+
+    Failed lookups (None) are not cached.
+    """
+
+    def decorator(lookup):
+        @functools.wraps(lookup)
+        def wrapper():
+            with _cache_lock:
+                cache = _read_cache()
+
+            try:
+                timestamp, (cachedVersion, date) = cache[key]
+                if time.time() - timestamp < ttl:
+                    return Version(cachedVersion), date
+            except (KeyError, TypeError, ValueError):
+                pass
+
+            result = lookup()
+            if result is not None:
+                with _cache_lock:
+                    cache = _read_cache()
+                    cache[key] = [time.time(), [str(result[0]), result[1]]]
+                    try:
+                        with open(cache_file, 'w') as f:
+                            json.dump(cache, f)
+                    except IOError:
+                        pass
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+@_cached("drozer")
 def latest_version():
     try:
         response = urlopen(Request("https://api.github.com/repos/WithSecureLabs/drozer/releases/latest", None, {"user-agent": "drozer: %s" % str(version)}), None, 1)
@@ -41,6 +99,7 @@ def latest_version():
     except URLError:
         return None
         
+@_cached("drozer-agent")
 def latest_agent_version():
     try:
         response = urlopen(Request("https://api.github.com/repos/WithSecureLabs/drozer-agent/releases/latest", None, {"user-agent": "drozer: %s" % str(version)}), None, 1)